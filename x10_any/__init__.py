@@ -5,8 +5,11 @@
 
 import logging
 import os
+import re
 import socket
 import sys
+import threading
+import time
 
 
 try:
@@ -63,6 +66,16 @@ class X10InvalidUnitNumber(X10BaseException):
     '''Invalid Unit Number exception'''
 
 
+class X10BatchError(X10BaseException):
+    '''Some commands in a batch could not be sent, the rest were.
+    errors is a list of ((house_code, unit_number, state), exception)
+    '''
+
+    def __init__(self, errors):
+        X10BaseException.__init__(self, 'unable to send %d command(s): %r' % (len(errors), errors))
+        self.errors = errors
+
+
 def normalize_housecode(house_code):
     """Returns a normalized house code, i.e. upper case.
     Raises exception X10InvalidHouseCode if house code appears to be invalid
@@ -157,13 +170,69 @@ class X10Driver(object):
 
         return self._x10_command(house_code, unit_number, state)
 
+    def x10_commands(self, commands):
+        """Send a batch of X10 commands, in order.
+
+        @param commands - sequence of (house_code, unit_number, state)
+                tuples, see x10_command(). Drivers may send the whole
+                batch in one go (e.g. one connection or serial port session)
+
+        Invalid or unsupported commands do not stop the rest of the batch
+        being sent, they are reported afterwards via X10BatchError.
+
+        Examples:
+            x10_commands([('A', 1, ON), ('A', 2, OFF)])
+        """
+        normalized_commands = []
+        errors = []
+        for command in commands:
+            house_code, unit_number, state = command
+            try:
+                house_code = normalize_housecode(house_code)
+                if unit_number is not None:
+                    unit_number = normalize_unitnumber(unit_number)
+            except X10BaseException as ex:
+                errors.append((command, ex))
+                continue
+            normalized_commands.append((house_code, unit_number, state))
+
+        try:
+            if normalized_commands:
+                self._x10_commands(normalized_commands)
+        except X10BatchError as ex:
+            errors.extend(ex.errors)
+        if errors:
+            raise X10BatchError(errors)
+
     def _x10_command(self, house_code, unit_number, state):
         """Real implementation"""
         print('x10_command%r' % ((house_code, unit_number, state), ))
         raise NotImplementedError()
 
-
-def netcat(hostname, port, content, log=None, read_after_send=False):
+    def _x10_commands(self, commands, **kwargs):
+        """Real implementation, default is one command at a time.
+        Extra keyword arguments are passed on to _x10_command().
+        Raises X10BatchError listing commands that failed.
+        """
+        errors = []
+        for command in commands:
+            try:
+                self._x10_command(*command, **kwargs)
+            except Exception as ex:
+                errors.append((command, ex))
+        if errors:
+            raise X10BatchError(errors)
+
+
+def netcat(hostname, port, content, log=None, read_after_send=False, read_until=None, timeout=None):
+    """Send content to hostname:port, optionally returning the response.
+
+    @param read_after_send - read until the server closes the connection
+    @param read_until - optional function, keep the connection open and
+        read until it returns True for a received line (bytes, without
+        line ending). Returns None if timeout expires first
+    @param timeout - optional socket timeout in seconds
+    """
     log = log or default_logger
 
     def read_all_from_sock(s):
@@ -176,21 +245,43 @@ def netcat(hostname, port, content, log=None, read_after_send=False):
                 break
         return b''.join(buff)
 
+    def read_until_line(s, is_last_line):
+        buff = b''
+        try:
+            while True:
+                data = s.recv(1024)
+                if not data:
+                    return None
+                buff += data
+                for line in buff.split(b'\n')[:-1]:  # complete lines only
+                    if is_last_line(line.rstrip(b'\r')):
+                        return buff
+        except socket.timeout:
+            log.warning('Timeout waiting for response from %s:%s', hostname, port)
+            return None
+
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if timeout is not None:
+            s.settimeout(timeout)
         log.debug('Trying connection to: %s:%s', hostname, port)
         s.connect((hostname, port))
 
         log.debug('Connected to: %s:%s', hostname, port)
         s.sendall(content)
         log.debug('sent: %r', content)
-        s.shutdown(socket.SHUT_WR)
 
-        if read_after_send:
-            received_data_after_send = read_all_from_sock(s)
+        if read_until:
+            received_data_after_send = read_until_line(s, read_until)
             log.debug('Received: %r', received_data_after_send)
         else:
-            received_data_after_send = None
+            s.shutdown(socket.SHUT_WR)
+
+            if read_after_send:
+                received_data_after_send = read_all_from_sock(s)
+                log.debug('Received: %r', received_data_after_send)
+            else:
+                received_data_after_send = None
 
         s.close()
         log.debug('Connection closed.')
@@ -206,6 +297,33 @@ def to_bytes(in_str):
     return in_str.encode('utf-8')
 
 
+def parse_mochad_status(data):
+    """Parse mochad "st" command output (bytes) into a dict of
+    (house_code, unit_number) -> ON/OFF, from the "Device status" section, e.g.
+
+        02/01 16:44:01 Device status
+        02/01 16:44:01 House P: 1=0,2=0,4=1
+        02/01 16:44:01 Security sensor status
+        02/01 16:44:01 End status
+    """
+    result = {}
+    in_device_status = False
+    for line in data.decode('utf-8', 'replace').splitlines():
+        if line.endswith(' status'):
+            in_device_status = line.endswith('Device status')
+            continue
+        if not in_device_status or ' House ' not in line:
+            continue
+        house_part, unit_part = line.split(' House ', 1)[1].split(':', 1)
+        house_code = normalize_housecode(house_part.strip())
+        for unit_state in unit_part.split(','):
+            if '=' not in unit_state:
+                continue
+            unit_number, state = unit_state.split('=', 1)
+            result[(house_code, normalize_unitnumber(unit_number))] = ON if state.strip() == '1' else OFF
+    return result
+
+
 class MochadDriver(X10Driver):
     """X10 command driver for Mochad (or compatible) server.
     See:
@@ -216,7 +334,7 @@ class MochadDriver(X10Driver):
         works under Windows and Linux and can control CM17A serial Firecracker
 
     NOTE This implementation opens the socket and then closes it for each command.
-    TODO implement status support, see https://github.com/zonyl/pytomation/blob/master/pytomation/interfaces/mochad.py
+    Device status is available via status(), using the mochad "st" command.
 
     Useful Mochad references:
       * Wiki is down as of 2016-07
@@ -226,24 +344,127 @@ class MochadDriver(X10Driver):
       * https://github.com/SensorFlare/mochad
     """
 
-    def __init__(self, device_address=None, default_type=None):
+    # Adaptive path selection tuning, see __init__()
+    latency_smoothing = 0.3  # weight given to newest round trip time
+    probe_interval = 10  # every Nth command to a device re-measures the slower path
+
+    def __init__(self, device_address=None, default_type=None, type_map=None, adaptive=False, ack_timeout=None, status_interval=5):
         """
         @param device_address - Optional tuple of (host_address, host_port).
             Defaults to localhost:1099
         @param default_type - Option type of device to send command,
             'rf'  or 'pl'. Defaults to 'rf'
+        @param type_map - Optional dict of house code or house code and
+            unit number to type, example={'A': 'pl', 'B3': 'rf'}.
+            House code and unit number entries take precedence over house
+            code entries, which take precedence over default_type.
+        @param adaptive - If True, devices not in type_map are sent over
+            whichever of 'rf' and 'pl' mochad has been fastest to echo
+            as transmitted for that device. Both paths are tried first
+            and the slower one is periodically re-measured.
+        @param ack_timeout - Seconds to wait for the mochad echo in adaptive
+            mode (and for status()). Defaults to 2
+        @param status_interval - Seconds status() results are cached for.
+            Defaults to 5, 0 disables the cache
         """
         self.device_address = device_address or ('localhost', 1099)
         self.default_type = default_type or 'rf'
         self.default_type = to_bytes(self.default_type)
-
-    def _x10_command(self, house_code, unit_number, state):
-        """Real implementation"""
-
-        # log = log or default_logger
+        self.type_map = {}
+        for key, device_type in (type_map or {}).items():
+            house_code = normalize_housecode(key[:1])
+            if key[1:]:
+                key = '%s%d' % (house_code, normalize_unitnumber(key[1:]))
+            else:
+                key = house_code
+            self.type_map[key] = to_bytes(device_type)
+        self.adaptive = adaptive
+        self.ack_timeout = ack_timeout or 2
+        self.latency = {}  # house and unit -> {type: smoothed round trip seconds}
+        self.command_count = {}  # house and unit -> number of adaptive commands sent
+        self.status_interval = status_interval
+        self._status = None
+        self._status_time = None
+        self._status_lock = threading.Lock()  # protects _status, _status_time and _status_updates, never held during I/O
+        self._status_fetch_lock = threading.Lock()  # one status fetch at a time
+        self._status_updates = 0  # count of _update_status() calls, to detect commands sent during a fetch
+
+    def status(self, refresh=False):
+        """Return dict of (house_code, unit_number) -> ON/OFF for every
+        device mochad knows about, e.g. {('A', 1): ON, ('A', 2): OFF}.
+
+        Fetched from mochad in one round trip, then cached for
+        status_interval seconds (concurrent callers share one fetch).
+        ON/OFF commands sent via this driver update the cached copy.
+        @param refresh - if True ignore the cache
+        """
         log = default_logger
+        with self._status_fetch_lock:
+            with self._status_lock:
+                now = time.time()
+                if not refresh and self._status is not None and now - self._status_time < self.status_interval:
+                    return dict(self._status)
+                updates = self._status_updates
+            mochad_host, mochad_port = self.device_address
+            result = netcat(mochad_host, mochad_port, b'st\n', read_until=lambda line: b'End status' in line, timeout=self.ack_timeout)
+            if result is None:
+                raise X10BaseException('no status received from mochad %s:%s' % (mochad_host, mochad_port))
+            status = parse_mochad_status(result)
+            log.debug('mochad status: %r', status)
+            with self._status_lock:
+                if updates == self._status_updates:
+                    self._status = status
+                    self._status_time = now
+                # else commands were sent during the fetch, may be missing from it so do not cache
+            return dict(status)
+
+    def _update_status(self, commands):
+        """Apply sent commands to the cached status, so status() is not stale"""
+        with self._status_lock:
+            self._status_updates += 1
+            if self._status is None:
+                return
+            for house_code, unit_number, state in commands:
+                if unit_number is not None and state.upper() in (ON, OFF):
+                    self._status[(house_code, unit_number)] = state.upper()
+                else:
+                    # effect unknown, e.g. dim or house wide; fetch again next time
+                    self._status = None
+                    return
+
+    def _select_type(self, house_code, house_and_unit, default_type=None):
+        """Return type (bytes) to use for house_and_unit, e.g. 'A1'
+        @param default_type - Optional override of self.default_type
+        """
+        default_type = default_type or self.default_type
+        device_type = self.type_map.get(house_and_unit) or self.type_map.get(house_code)
+        if device_type:
+            return device_type
+        if not self.adaptive:
+            return default_type
+
+        other_type = b'pl' if default_type == b'rf' else b'rf'
+        timings = self.latency.get(house_and_unit, {})
+        for device_type in (default_type, other_type):
+            if device_type not in timings:
+                return device_type
+        fast_type, slow_type = sorted((default_type, other_type), key=timings.get)
+        count = self.command_count.get(house_and_unit, 0)
+        if count and count % self.probe_interval == 0:
+            return slow_type
+        return fast_type
+
+    def _record_latency(self, house_and_unit, device_type, elapsed):
+        timings = self.latency.setdefault(house_and_unit, {})
+        if device_type in timings:
+            elapsed = timings[device_type] + self.latency_smoothing * (elapsed - timings[device_type])
+        timings[device_type] = elapsed
+        self.command_count[house_and_unit] = self.command_count.get(house_and_unit, 0) + 1
+
+    def _mochad_cmd(self, house_code, unit_number, state, default_type=None):
+        """Return (type, house_and_unit, command line) as bytes for mochad"""
         if state.startswith('xdim') or state.startswith('dim') or state.startswith('bright'):
-            raise NotImplementedError('xdim/dim/bright %r' % ((house_code, unit_num, state), ))
+            raise NotImplementedError('xdim/dim/bright %r' % ((house_code, unit_number, state), ))
 
         if unit_number is not None:
             house_and_unit = '%s%d' % (house_code, unit_number)
@@ -251,14 +472,81 @@ class MochadDriver(X10Driver):
             raise NotImplementedError('mochad all ON/OFF %r' % ((house_code, unit_number, state), ))
             house_and_unit = house_code
 
+        device_type = self._select_type(house_code, house_and_unit, default_type)
         house_and_unit = to_bytes(house_and_unit)
         # TODO normalize/validate state
         state = to_bytes(state)
-        mochad_cmd = self.default_type + b' ' + house_and_unit + b' ' + state + b'\n'  # byte concat works with older Python 3.4
+        mochad_cmd = device_type + b' ' + house_and_unit + b' ' + state + b'\n'  # byte concat works with older Python 3.4
+        return device_type, house_and_unit, mochad_cmd
+
+    def _x10_command(self, house_code, unit_number, state, default_type=None):
+        """Real implementation
+        @param default_type - Optional override of self.default_type (bytes)
+        """
+
+        # log = log or default_logger
+        log = default_logger
+        device_type, house_and_unit, mochad_cmd = self._mochad_cmd(house_code, unit_number, state, default_type)
+        adaptive = self.adaptive and house_and_unit.decode('utf-8') not in self.type_map and house_code not in self.type_map
         log.debug('mochad send: %r', mochad_cmd)
         mochad_host, mochad_port = self.device_address
-        result = netcat(mochad_host, mochad_port, mochad_cmd)
+        if adaptive:
+            # mochad echoes to all clients, e.g. "05/22 18:22:51 Tx RF HouseUnit: A1 Func: On"
+            # match whole unit, so the echo for A10 is not taken as the echo for A1
+            echo = re.compile(br'\bTx ' + device_type.upper() + br' HouseUnit: ' + house_and_unit + br'(\s|$)')
+            start = time.time()
+            result = netcat(mochad_host, mochad_port, mochad_cmd, read_until=echo.search, timeout=self.ack_timeout)
+            elapsed = time.time() - start
+            if result is None:
+                # no echo, penalize path
+                elapsed = self.ack_timeout
+            self._record_latency(house_and_unit.decode('utf-8'), device_type, elapsed)
+            log.debug('mochad %r round trip %.3f seconds', device_type, elapsed)
+        else:
+            result = netcat(mochad_host, mochad_port, mochad_cmd)
         log.debug('mochad received: %r', result)
+        self._update_status([(house_code, unit_number, state)])
+
+    def _x10_commands(self, commands, default_type=None):
+        """Real implementation, sends all commands over a single connection.
+        In adaptive mode commands are sent (and timed) one at a time.
+        @param default_type - Optional override of self.default_type (bytes)
+        """
+        log = default_logger
+        if self.adaptive:
+            return X10Driver._x10_commands(self, commands, default_type=default_type)
+
+        mochad_cmds = []
+        sent_commands = []
+        errors = []
+        for command in commands:
+            try:
+                mochad_cmds.append(self._mochad_cmd(*command, default_type=default_type)[2])
+                sent_commands.append(command)
+            except Exception as ex:
+                # e.g. NotImplementedError, send the rest
+                errors.append((command, ex))
+
+        if mochad_cmds:
+            mochad_cmd = b''.join(mochad_cmds)
+            log.debug('mochad send: %r', mochad_cmd)
+            mochad_host, mochad_port = self.device_address
+            result = netcat(mochad_host, mochad_port, mochad_cmd)
+            log.debug('mochad received: %r', result)
+            self._update_status(sent_commands)
+        if errors:
+            raise X10BatchError(errors)
+
+
+def guess_serial_port():
+    """Returns name of first serial port found"""
+    log = default_logger
+    log.info('Guess serial port...')
+    possible_serial_ports = list(serial.tools.list_ports.comports())
+    log.debug('possible_serial_ports %r', possible_serial_ports)
+    device_address = possible_serial_ports[0][0]
+    log.debug('Serial port guessed')
+    return device_address
 
 
 class FirecrackerDriver(X10Driver):
@@ -278,19 +566,12 @@ class FirecrackerDriver(X10Driver):
             raise X10BaseException('no CM17A python module available')  # raise ImportError instead?
 
         if device_address is None:
-            log.info('Guess serial port...')
-            possible_serial_ports = list(serial.tools.list_ports.comports())
-            log.debug('possible_serial_ports %r', possible_serial_ports)
-            device_address = possible_serial_ports[0][0]
-            log.debug('Serial port guessed')
+            device_address = guess_serial_port()
         self.device_address = device_address
         log.debug('CM17A Serial port %r', self.device_address)
 
-    def _x10_command(self, house_code, unit_number, state):
-        """Real implementation"""
-
-        # log = log or default_logger
-        log = default_logger
+    def _x10_command_str(self, house_code, unit_number, state):
+        """Return x10 (cm17a) module command string, e.g. 'A1 on'"""
 
         # FIXME move these functions?
         def scale_255_to_8(x):
@@ -309,6 +590,44 @@ class FirecrackerDriver(X10Driver):
             factor = x / 31.0
             return 8 - int(abs(round(8 * factor)))
 
+        if unit_number is not None:
+            if state.startswith('xdim') or state.startswith('dim') or state.startswith('bright'):
+                dim_count = int(state.split()[-1])
+                if state.startswith('xdim'):
+                    dim_count = scale_255_to_8(dim_count)
+                else:
+                    # assumed dim or bright
+                    dim_count = scale_31_to_8(dim_count)
+                dim_str = ', %s dim' % (house_code, )
+                dim_list = []
+                for _ in range(dim_count):
+                    dim_list.append(dim_str)
+                dim_str = ''.join(dim_list)
+                if dim_count == 0:
+                    # No dim
+                    x10_command_str = '%s%s %s' % (house_code, unit_number, 'on')
+                else:
+                    # If lamp is already dimmed, need to turn it off and then back on
+                    x10_command_str = '%s%s %s, %s%s %s%s' % (house_code, unit_number, 'off', house_code, unit_number, 'on', dim_str)
+            else:
+                x10_command_str = '%s%s %s' % (house_code, unit_number, state)
+        else:
+            # Assume a command for house not a specific unit
+            state = x10_mapping[state]
+
+            x10_command_str = '%s %s' % (house_code, state)
+        translate_commands = getattr(x10, '_translateCommands', None)
+        if translate_commands is not None:
+            # raises KeyError/ValueError for unsupported commands, e.g. 'A1 blink'
+            list(translate_commands(x10_command_str))
+        return x10_command_str
+
+    def _x10_command(self, house_code, unit_number, state):
+        """Real implementation"""
+
+        # log = log or default_logger
+        log = default_logger
+
         serial_port_name = self.device_address
         house_code = normalize_housecode(house_code)
         if unit_number is not None:
@@ -317,37 +636,37 @@ class FirecrackerDriver(X10Driver):
             # command is intended for the entire house code, not a single unit number
             if firecracker:
                 log.error('using python-x10-firecracker-interface NO support for all ON/OFF')
-        # TODO normalize/validate state, sort of implemented below
+        # TODO normalize/validate state, sort of implemented in _x10_command_str()
 
         if firecracker:
             log.debug('firecracker send: %r', (serial_port_name, house_code, unit_number, state))
             firecracker.send_command(serial_port_name, house_code, unit_number, state)
         else:
-            if unit_number is not None:
-                if state.startswith('xdim') or state.startswith('dim') or state.startswith('bright'):
-                    dim_count = int(state.split()[-1])
-                    if state.startswith('xdim'):
-                        dim_count = scale_255_to_8(dim_count)
-                    else:
-                        # assumed dim or bright
-                        dim_count = scale_31_to_8(dim_count)
-                    dim_str = ', %s dim' % (house_code, )
-                    dim_list = []
-                    for _ in range(dim_count):
-                        dim_list.append(dim_str)
-                    dim_str = ''.join(dim_list)
-                    if dim_count == 0:
-                        # No dim
-                        x10_command_str = '%s%s %s' % (house_code, unit_number, 'on')
-                    else:
-                        # If lamp is already dimmed, need to turn it off and then back on
-                        x10_command_str = '%s%s %s, %s%s %s%s' % (house_code, unit_number, 'off', house_code, unit_number, 'on', dim_str)
-                else:
-                    x10_command_str = '%s%s %s' % (house_code, unit_number, state)
-            else:
-                # Assume a command for house not a specific unit
-                state = x10_mapping[state]
+            x10_command_str = self._x10_command_str(house_code, unit_number, state)
+            log.debug('x10_command_str send: %r', x10_command_str)
+            x10.sendCommands(serial_port_name, x10_command_str)
+
+    def _x10_commands(self, commands):
+        """Real implementation, sends all commands in a single serial port session
+        (unless using python-x10-firecracker-interface)
+        """
+        log = default_logger
+        if firecracker:
+            return X10Driver._x10_commands(self, commands)
 
-                x10_command_str = '%s %s' % (house_code, state)
+        serial_port_name = self.device_address
+        x10_command_strs = []
+        errors = []
+        for command in commands:
+            try:
+                x10_command_strs.append(self._x10_command_str(*command))
+            except Exception as ex:
+                # e.g. KeyError for unsupported house command, send the rest
+                errors.append((command, ex))
+
+        if x10_command_strs:
+            x10_command_str = ', '.join(x10_command_strs)
             log.debug('x10_command_str send: %r', x10_command_str)
             x10.sendCommands(serial_port_name, x10_command_str)
+        if errors:
+            raise X10BatchError(errors)
@@ -25,15 +25,30 @@ Originally from http://www.averdevelopment.com/python/x10.html
 Modified to be:
   * Python 3 compatible
   * Thread safe
+  * Process safe, serial port use is queued via advisory lock files
   * Include additional RF doc links
 """
 
 __version__ = 1.1
 
+import errno
+import logging
+import os
+import re
 import sys
 import time
 import threading
 
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
 import serial
 
 # The FireCracker spec is at http://text.staticfree.info/cm17a_proto.txt
@@ -42,6 +57,13 @@ import serial
 leadInOutDelay = 0.5
 bitDelay = 0.001
 
+# Cross process locking of the serial port, see PortLock
+lockDirectory = None  # None means _defaultLockDirectory(), must be the same for every process using the port
+lockTimeout = None  # seconds to wait for the port, None means wait forever
+lockPollDelay = 0.01
+
+log = logging.getLogger(__name__)
+
 # contants used for translating commands into bit strings
 
 houseCodes = dict(A=0x60, B=0x70, C=0x40, D=0x50,
@@ -143,11 +165,244 @@ def _setRTSDTR(port, RTS, DTR):
     port.setDTR(DTR)
 
 
-# Public Interface (programmatic and command line)
+# Cross process serial port locking
 
 mutex = threading.Lock()
 
-def sendCommands(comPort, commands):
+
+class PortLockTimeout(Exception):
+    """Timed out waiting for exclusive use of the serial port."""
+
+
+def _defaultLockDirectory():
+    """Return a system wide directory for lock files.
+
+    Unlike tempfile.gettempdir() this does not depend on the user or
+    $TMPDIR, so cron jobs, web apps and daemons find the same lock files.
+    """
+    if os.name == 'nt':
+        candidates = [os.environ.get('ProgramData'), os.environ.get('ALLUSERSPROFILE')]
+    else:
+        # NOTE /tmp may be private to a service (systemd PrivateTmp), if so set lockDirectory
+        candidates = ['/run/lock', '/var/lock', '/tmp']
+    for directory in candidates:
+        if directory and os.path.isdir(directory) and os.access(directory, os.W_OK):
+            return directory
+    raise IOError(errno.ENOENT, 'no shared lock directory found, set cm17a.lockDirectory')
+
+
+def _lockFileName(comPort):
+    """Return the lock file name shared by all processes using comPort."""
+    if os.path.exists(comPort):
+        # so that symlinks like /dev/serial/by-id/... share a lock with the real device
+        comPort = os.path.realpath(comPort)
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', comPort.strip('/\\'))
+    return os.path.join(lockDirectory or _defaultLockDirectory(), 'x10_any_cm17a_%s.lock' % name)
+
+
+def _openLockFile(fileName):
+    """Open (creating if needed) fileName for locking, return file descriptor."""
+    try:
+        return os.open(fileName, os.O_RDWR | os.O_CREAT, 438)  # 0666, subject to umask
+    except (IOError, OSError):
+        # created by another user, flock works on read only files
+        return os.open(fileName, os.O_RDONLY)
+
+
+def _tryLock(fd):
+    """Attempt a non-blocking exclusive lock on fd, return True on success."""
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt:
+            os.lseek(fd, 0, 0)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _unlock(fd):
+    """Release lock on fd obtained by _tryLock()."""
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    elif msvcrt:
+        os.lseek(fd, 0, 0)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def _removeFile(fileName):
+    try:
+        os.remove(fileName)
+    except (IOError, OSError):
+        pass
+
+
+class PortLock(object):
+    """Exclusive use of a serial port, shared between threads and processes.
+
+    Threads in this process are serialized by the module level mutex.
+    Processes are serialized by an advisory lock file, named after the
+    port, in lockDirectory (by default a system wide directory such as
+    /run/lock, see _defaultLockDirectory()). On POSIX the serial port is
+    also opened exclusively. Waiting processes are served in arrival order;
+    each waiter holds a locked ticket file in a queue directory next to
+    the lock file and only tries for the port lock once every earlier
+    ticket has gone. Tickets left behind by dead processes are unlocked,
+    so they are detected, skipped and removed. The queue directory is
+    created world writable and sticky, so processes running as different
+    users share one queue.
+
+    After acquire() the attribute waited holds the number of seconds
+    spent waiting for the port.
+
+        >>> lock = PortLock('/dev/ttyUSB0', timeout=5)
+        >>> with lock:
+        ...     pass  # bit-bang the port
+    """
+
+    def __init__(self, comPort, timeout=None):
+        self.comPort = comPort
+        self.timeout = timeout
+        self.fileName = _lockFileName(comPort)
+        self.queueDirectory = self.fileName + '.queue'
+        self.staleTicketAge = 10  # seconds, for unlocked .tmp tickets of processes that died while queuing
+        self.waited = None
+        self._fd = None
+
+    def _sleep(self, deadline):
+        if deadline is not None and time.time() >= deadline:
+            raise PortLockTimeout('timed out after %r seconds waiting for serial port %s' % (self.timeout, self.comPort))
+        time.sleep(lockPollDelay)
+
+    def _enqueue(self, deadline):
+        """Create and lock a ticket file in the queue, return (fd, name)."""
+        try:
+            os.makedirs(self.queueDirectory)
+            # shared by processes of different users (cron, web app, daemon),
+            # sticky so users can only remove their own tickets
+            os.chmod(self.queueDirectory, 1023)  # 01777
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        ticket = '%017.6f-%d-%d' % (time.time(), os.getpid(), threading.current_thread().ident or 0)
+        ticketName = os.path.join(self.queueDirectory, ticket)
+        if msvcrt:
+            # Windows can not rename an open file, nor remove one, so a
+            # ticket seen (briefly) unlocked is never removed from the queue
+            fd = os.open(ticketName, os.O_RDWR | os.O_CREAT | os.O_EXCL, 438)
+        else:
+            tmpName = ticketName + '.tmp'
+            fd = _openLockFile(tmpName)
+        try:
+            while not _tryLock(fd):
+                # another waiter is checking whether this ticket is stale
+                self._sleep(deadline)
+            if not msvcrt:
+                # only make ticket visible once locked, so others never see it as stale
+                os.rename(tmpName, ticketName)
+        except:
+            os.close(fd)
+            _removeFile(ticketName if msvcrt else tmpName)
+            raise
+        return fd, ticketName
+
+    def _isFirst(self, ticketName):
+        """Return True if no live ticket is queued ahead of ticketName."""
+        ticket = os.path.basename(ticketName)
+        for other in sorted(os.listdir(self.queueDirectory)):
+            if other >= ticket:
+                return True
+            otherName = os.path.join(self.queueDirectory, other)
+            try:
+                fd = _openLockFile(otherName)
+            except (IOError, OSError):
+                continue  # already gone
+            try:
+                if not _tryLock(fd):
+                    if other.endswith('.tmp'):
+                        continue  # not queued yet
+                    return False  # live waiter ahead of us
+                _unlock(fd)
+            finally:
+                os.close(fd)
+            if other.endswith('.tmp') and not self._isOldTicket(other):
+                # may be about to be locked by its creator, see _enqueue()
+                continue
+            log.debug('removing stale serial port ticket %r', otherName)
+            _removeFile(otherName)
+        return True
+
+    def _isOldTicket(self, ticket):
+        """Return True if ticket was created more than staleTicketAge seconds ago."""
+        try:
+            created = float(ticket.split('-', 1)[0])
+        except ValueError:
+            return True  # not one of ours
+        return time.time() - created > self.staleTicketAge
+
+    def acquire(self):
+        start = time.time()
+        deadline = None
+        if self.timeout is not None:
+            deadline = start + self.timeout
+        if deadline is None:
+            mutex.acquire()
+        else:
+            while not mutex.acquire(False):
+                self._sleep(deadline)
+        try:
+            try:
+                ticketFd, ticketName = self._enqueue(deadline)
+            except (IOError, OSError) as ex:
+                if ex.errno not in (errno.EACCES, errno.EPERM):
+                    raise
+                # e.g. queue directory created by another user with an old version
+                log.warning('unable to queue for serial port %s, waiting unordered: %r', self.comPort, ex)
+                ticketFd, ticketName = None, None
+            try:
+                while ticketName and not self._isFirst(ticketName):
+                    self._sleep(deadline)
+                fd = _openLockFile(self.fileName)
+                try:
+                    # processes not using the queue (older versions) are still excluded here
+                    while not _tryLock(fd):
+                        self._sleep(deadline)
+                except:
+                    os.close(fd)
+                    raise
+            finally:
+                if ticketName:
+                    _unlock(ticketFd)
+                    os.close(ticketFd)
+                    _removeFile(ticketName)
+        except:
+            mutex.release()
+            raise
+        self._fd = fd
+        self.waited = time.time() - start
+        log.debug('waited %.3f seconds for serial port %s', self.waited, self.comPort)
+        return self.waited
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        try:
+            _unlock(fd)
+            os.close(fd)
+        finally:
+            mutex.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+# Public Interface (programmatic and command line)
+
+def sendCommands(comPort, commands, timeout=None):
     """Send X10 commands using the FireCracker on comPort
 
     comPort should be the name of a serial port on the host platform. On
@@ -162,6 +417,10 @@ def sendCommands(comPort, commands):
     'All On', 'All Off', 'Lamps On', and 'Lamps Off' commands should also
     be used with a house code alone.
 
+    timeout is the number of seconds to wait for other threads and processes
+    to finish with comPort, defaults to lockTimeout. PortLockTimeout is
+    raised if the port is still busy. Returns number of seconds spent waiting.
+
     # Turn on module A1
     >>> sendCommands('com1', 'A1 On')
 
@@ -174,10 +433,20 @@ def sendCommands(comPort, commands):
     # Turn on module A1 and dim it 3 steps, then brighten it 1 step
     >>> sendCommands('com1', 'A1 On, A Dim, A Dim, A Dim, A Bright')
     """
-    mutex.acquire()
+    if timeout is None:
+        timeout = lockTimeout
+    lock = PortLock(comPort, timeout=timeout)
+    lock.acquire()
+    port = None
     try:
         try:
-            port = serial.Serial(port=comPort)
+            if os.name == 'posix':
+                # also lock the port itself, so processes that disagree on
+                # lockDirectory fail rather than interleave transmissions
+                port = serial.Serial(port=comPort, exclusive=True)
+            else:
+                # Windows only allows one open handle per serial port
+                port = serial.Serial(port=comPort)
             header = '11010101 10101010'
             footer = '10101101'
             for command in _translateCommands(commands):
@@ -187,7 +456,10 @@ def sendCommands(comPort, commands):
             print('')
             raise
     finally:
-        mutex.release()
+        if port is not None:
+            port.close()
+        lock.release()
+    return lock.waited
 
 
 def main(argv=None):
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Minimal HTTP/JSON gateway to an X10Driver, stdlib only.
+
+POST a JSON command, or list of commands, to any path:
+
+    {"house": "A", "unit": 1, "state": "ON"}
+    [{"house": "A", "unit": 1, "state": "ON"}, {"house": "B", "unit": 2, "state": "OFF"}]
+    {"commands": [...], "wait": true}
+
+A "unit" of null sends a house code command, e.g. "state": "all_units_off",
+if the driver supports it (FirecrackerDriver does, MochadDriver does not).
+
+Request bodies over MAX_CONTENT_LENGTH bytes are rejected (413).
+
+The response (202) is sent as soon as the commands are queued. With
+"wait": true (or ?wait=1) the response (200) is sent once the driver
+has sent them. Commands arriving within batch_window of each other
+are sent to the driver as a single batch, see X10Driver.x10_commands().
+
+    python -m x10_any.gateway [listen_port [driver_url [bind_address]]]
+
+There is no authentication, so by default only local clients can connect
+(127.0.0.1). Listening on other interfaces, e.g. bind_address 0.0.0.0,
+lets anyone on that network control devices.
+
+    import x10_any
+    from x10_any.gateway import make_server
+
+    server = make_server(x10_any.MochadDriver(), ('127.0.0.1', 8080))
+    server.serve_forever()
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+    import queue
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+    import Queue as queue
+
+try:
+    basestring
+except NameError:
+    # python 3
+    basestring = str
+
+from . import X10BaseException, X10BatchError, normalize_housecode, normalize_unitnumber
+from .registry import get_driver
+
+
+default_logger = logging.getLogger(__name__)
+
+MAX_CONTENT_LENGTH = 64 * 1024  # bytes, more than enough for a few hundred commands
+
+
+class QueuedCommands(object):
+    """Commands submitted together, see CommandBatcher.submit()"""
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for commands to be sent, returns False on timeout.
+        Raises the driver exception if sending failed.
+        """
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class CommandBatcher(object):
+    """Single worker thread that sends queued commands to a driver,
+    merging everything queued within batch_window into one driver batch.
+    """
+
+    def __init__(self, driver, batch_window=0.05, log=None):
+        self.driver = driver
+        self.batch_window = batch_window
+        self.log = log or default_logger
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='x10_any.gateway')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, commands):
+        """Queue list of (house_code, unit_number, state), returns QueuedCommands"""
+        queued = QueuedCommands(commands)
+        self._queue.put(queued)
+        return queued
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            queued = self._queue.get()
+            if queued is None:
+                return
+            batch = [queued]
+            deadline = time.time() + self.batch_window
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    queued = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if queued is None:
+                    self._queue.put(None)  # stop after sending this batch
+                    break
+                batch.append(queued)
+            self._send(batch)
+
+    def _send(self, batch):
+        commands = []
+        for queued in batch:
+            commands.extend(queued.commands)
+        self.log.debug('gateway sending: %r', commands)
+        failed = {}  # command -> exception
+        error = None
+        try:
+            self.driver.x10_commands(commands)
+        except X10BatchError as ex:
+            # rest of batch was sent, only fail the submitters of bad commands
+            for command, command_error in ex.errors:
+                self.log.error('ERROR: sending %r: %r', command, command_error)
+                failed[tuple(command)] = command_error
+        except Exception as ex:
+            self.log.error('ERROR: sending %r: %r', commands, ex)
+            error = ex
+        for queued in batch:
+            queued.error = error
+            errors = [(command, failed[command]) for command in queued.commands if command in failed]
+            if errors:
+                queued.error = X10BatchError(errors)
+            queued.done.set()
+
+
+def parse_commands(body):
+    """Parse JSON request body, returns (commands, wait).
+    Raises ValueError or X10BaseException for invalid requests.
+    """
+    data = json.loads(body.decode('utf-8'))
+    wait = False
+    if isinstance(data, dict) and 'commands' in data:
+        wait = data.get('wait', False)
+        if not isinstance(wait, bool):
+            raise ValueError('wait must be true or false, got %r' % (wait, ))
+        data = data['commands']
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not data:
+        raise ValueError('expected a command or list of commands')
+    commands = []
+    for command in data:
+        if not isinstance(command, dict) or not isinstance(command.get('state'), basestring) or not command['state']:
+            raise ValueError('invalid command %r' % (command, ))
+        house_code = normalize_housecode(command.get('house'))
+        unit_number = command.get('unit')
+        if unit_number is not None:
+            unit_number = normalize_unitnumber(unit_number)
+        commands.append((house_code, unit_number, str(command['state'])))
+    return commands, wait
+
+
+class GatewayRequestHandler(BaseHTTPRequestHandler):
+    """Expects server to have batcher and wait_timeout attributes, see make_server()"""
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_json(400, {'error': 'invalid Content-Length'})
+            return
+        if length > MAX_CONTENT_LENGTH:
+            self.send_json(413, {'error': 'request body over %d bytes' % MAX_CONTENT_LENGTH})
+            return
+        try:
+            commands, wait = parse_commands(self.rfile.read(length))
+        except (ValueError, X10BaseException) as ex:
+            self.send_json(400, {'error': str(ex)})
+            return
+        query = parse_qs(urlparse(self.path).query)
+        wait = wait or query.get('wait', ['0'])[0] not in ('', '0', 'false')
+
+        queued = self.server.batcher.submit(commands)
+        if not wait:
+            self.send_json(202, {'queued': len(commands)})
+            return
+        try:
+            if not queued.wait(self.server.wait_timeout):
+                self.send_json(504, {'error': 'timeout', 'queued': len(commands)})
+                return
+        except Exception as ex:
+            self.send_json(502, {'error': repr(ex)})
+            return
+        self.send_json(200, {'sent': len(commands)})
+
+    def log_message(self, format, *args):
+        default_logger.info('%s - %s', self.address_string(), format % args)
+
+
+class GatewayServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(driver, server_address=('127.0.0.1', 8080), batch_window=0.05, wait_timeout=30):
+    """Return GatewayServer, call serve_forever() on it to handle requests.
+
+    @param driver - X10Driver instance, shared by all requests
+    @param server_address - (host, port) to listen on, defaults to
+        local clients only. NOTE requests are not authenticated
+    @param batch_window - seconds to collect commands into one driver batch
+    @param wait_timeout - seconds a wait request waits for the driver
+    """
+    server = GatewayServer(server_address, GatewayRequestHandler)
+    server.batcher = CommandBatcher(driver, batch_window=batch_window)
+    server.wait_timeout = wait_timeout
+    return server
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    logging.basicConfig()
+    port = int(argv[0]) if argv else 8080
+    driver_url = argv[1] if argv[1:] else 'mochad://'  # see x10_any.registry
+    bind_address = argv[2] if argv[2:] else '127.0.0.1'
+    server = make_server(get_driver(driver_url), (bind_address, port))
+    default_logger.info('listening on %s port %d', bind_address, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    server.batcher.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Build drivers from URLs and share one driver per endpoint.
+
+Supported URLs:
+
+    mochad://                       localhost:1099, rf
+    mochad://host:1099?type=pl      options; type (rf/pl, per URL) and, for the
+                                    shared driver, adaptive, ack_timeout, status_interval
+    cm17a:///dev/ttyUSB0            CM17A Firecracker (firecracker:// is an alias)
+    cm17a://COM11
+    cm17a://                        first serial port found
+
+    import x10_any
+    from x10_any.registry import get_driver
+
+    dev = get_driver('mochad://localhost:1099?type=pl')
+    dev.x10_command('A', 1, x10_any.ON)
+    dev.close()  # underlying driver closed once every user has closed it
+"""
+
+import os
+import threading
+
+try:
+    # Python 3
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    # Python 2
+    from urlparse import parse_qs, urlparse
+
+from . import FirecrackerDriver, MochadDriver, X10BaseException, X10Driver, guess_serial_port, to_bytes
+
+
+def _parse_bool(value):
+    return value.lower() not in ('', '0', 'false', 'no', 'off')
+
+
+# option name -> converter, for mochad:// query strings.
+# These configure the (shared) driver, so must agree between URLs for the same endpoint
+mochad_options = {
+    'adaptive': _parse_bool,
+    'ack_timeout': float,
+    'status_interval': float,
+}
+
+mochad_types = ('rf', 'pl')
+
+
+def parse_driver_url(url):
+    """Return (driver_class, device_address, driver_options, handle_options)
+    for url. Normalized, so that equivalent URLs return equal values.
+
+    driver_options are keyword arguments for driver_class.
+    handle_options only apply to commands sent via the URL, e.g. the
+    mochad type (default_type), see SharedDriver.
+    """
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    options = {}
+    for name, values in parse_qs(parsed.query).items():
+        options[name] = values[-1]
+
+    if scheme == 'mochad':
+        driver_options = {}
+        handle_options = {}
+        for name, value in options.items():
+            if name == 'type':
+                if value.lower() not in mochad_types:
+                    raise X10BaseException('invalid mochad type %r in %r, expected one of %s' % (value, url, '/'.join(mochad_types)))
+                handle_options['default_type'] = value.lower()
+                continue
+            if name not in mochad_options:
+                raise X10BaseException('unknown mochad option %r in %r' % (name, url))
+            try:
+                driver_options[name] = mochad_options[name](value)
+            except ValueError:
+                raise X10BaseException('invalid mochad option %s=%r in %r' % (name, value, url))
+        device_address = ((parsed.hostname or 'localhost').lower(), parsed.port or 1099)
+        return MochadDriver, device_address, driver_options, handle_options
+    elif scheme in ('cm17a', 'firecracker'):
+        if options:
+            raise X10BaseException('%s takes no options %r' % (scheme, url))
+        serial_port_name = parsed.netloc + parsed.path or None
+        return FirecrackerDriver, serial_port_name, {}, {}
+    raise X10BaseException('unsupported driver url %r' % (url, ))
+
+
+def driver_from_url(url):
+    """Return a new (unshared) driver for url"""
+    driver_class, device_address, driver_options, handle_options = parse_driver_url(url)
+    kwargs = dict(driver_options)
+    kwargs.update(handle_options)
+    return driver_class(device_address, **kwargs)
+
+
+class SharedDriver(X10Driver):
+    """Handle to a driver shared via DriverRegistry.
+
+    Commands are serialized per shared driver, and sent with the options
+    of the URL this handle was created from (e.g. mochad type). Other
+    attributes (e.g. MochadDriver.status()) are passed through. close()
+    (or garbage collection) releases this handle only, the shared driver
+    is closed when the last handle is released.
+    """
+
+    def __init__(self, registry, key, entry, handle_options):
+        self._registry = registry
+        self._key = key
+        self._entry = entry
+        self._options = {}
+        if 'default_type' in handle_options:
+            self.default_type = self._options['default_type'] = to_bytes(handle_options['default_type'])
+        self.driver = entry.driver
+        self.device_address = entry.driver.device_address
+
+    def __getattr__(self, name):
+        if name.startswith('_') or 'driver' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.driver, name)
+
+    def close(self):
+        # if called multiple times, be silent
+        registry = self.__dict__.pop('_registry', None)
+        if registry is not None:
+            self.__dict__.pop('driver', None)
+            registry._release(self._key)
+        X10Driver.close(self)
+
+    def _x10_command(self, house_code, unit_number, state):
+        with self._entry.lock:
+            return self.driver._x10_command(house_code, unit_number, state, **self._options)
+
+    def _x10_commands(self, commands):
+        with self._entry.lock:
+            return self.driver._x10_commands(commands, **self._options)
+
+
+class _RegistryEntry(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.lock = threading.RLock()
+        self.count = 0
+
+
+class DriverRegistry(object):
+    """Thread safe, reference counted, cache of drivers keyed by endpoint
+    (driver class and device address)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()  # .locked, True while this thread holds (or is taking) _lock
+        self._entries = {}  # key -> _RegistryEntry
+        self._released = []  # keys of released handles, applied by _unlock_registry()
+
+    def get_driver(self, url):
+        """Return a SharedDriver handle for url, creating the driver if needed.
+        Call close() on the handle when finished with it.
+        Raises X10BaseException if url sets driver options that differ
+        from those of the existing shared driver for the endpoint.
+        """
+        driver_class, device_address, driver_options, handle_options = parse_driver_url(url)
+        if driver_class is FirecrackerDriver:
+            # so that cm17a:// and the port it finds share a driver, as do symlinks
+            if device_address is None:
+                device_address = guess_serial_port()
+            if os.path.exists(device_address):
+                device_address = os.path.realpath(device_address)
+        key = (driver_class, device_address)
+        new_entry = None
+        while True:
+            self._lock_registry()
+            try:
+                entry = self._entries.get(key)
+                if entry is None and new_entry is not None:
+                    entry = self._entries[key] = new_entry
+                    new_entry = None
+                if entry is not None:
+                    for name, value in driver_options.items():
+                        if getattr(entry.driver, name) != value:
+                            raise X10BaseException('%r option %s=%r conflicts with shared driver %s=%r' % (url, name, value, name, getattr(entry.driver, name)))
+                    entry.count += 1
+                    break
+            finally:
+                self._unlock_registry()
+            # not under the lock, constructing may be slow or run __del__ of other handles
+            new_entry = _RegistryEntry(driver_class(device_address, **driver_options))
+        if new_entry is not None:
+            new_entry.driver.close()  # another thread created the driver first
+        return SharedDriver(self, key, entry, handle_options)
+
+    def _release(self, key):
+        """Release a handle for key. Safe to call from __del__, even while
+        this thread holds _lock (e.g. garbage collection in get_driver())
+        """
+        self._released.append(key)
+        if getattr(self._local, 'locked', False):
+            return  # applied when this thread unlocks
+        self._lock_registry()
+        self._unlock_registry()
+
+    def _lock_registry(self):
+        self._local.locked = True  # before acquiring, so __del__ can not block on _lock
+        self._lock.acquire()
+
+    def _unlock_registry(self):
+        """Apply released handles, closing unused drivers, and release _lock"""
+        while True:
+            closing = []
+            while self._released:
+                key = self._released.pop()
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                entry.count -= 1
+                if entry.count <= 0:
+                    del self._entries[key]
+                    closing.append(entry.driver)
+            self._lock.release()
+            self._local.locked = False
+            for driver in closing:
+                driver.close()
+            if not self._released:
+                return
+            # released (by this thread's __del__) while unlocking
+            self._lock_registry()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+default_registry = DriverRegistry()
+get_driver = default_registry.get_driver
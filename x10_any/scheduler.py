@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Delayed and recurring X10 commands, dispatched via any X10Driver.
+
+All pending commands share one heap and one thread (rather than a
+threading.Timer each). Commands can be cancelled and rescheduled by
+(house_code, unit_number). Commands falling due together are sent as a
+single driver batch, see X10Driver.x10_commands().
+
+    import x10_any
+    from x10_any.scheduler import Scheduler
+
+    scheduler = Scheduler(x10_any.MochadDriver())
+    scheduler.start()
+    scheduler.call_later(10 * 60, 'A', 3, x10_any.OFF, replace=True)  # A3 off in 10 minutes
+    scheduler.call_later(10 * 60, 'A', 3, x10_any.OFF, replace=True)  # motion again, restart the 10 minutes
+    scheduler.cancel('A', 3)
+    scheduler.stop()
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from . import X10BatchError, normalize_housecode, normalize_unitnumber
+
+
+default_logger = logging.getLogger(__name__)
+
+
+class ScheduledCommand(object):
+    """A pending X10 command, see Scheduler.call_at()"""
+
+    def __init__(self, when, house_code, unit_number, state, repeat=None):
+        self.when = when
+        self.house_code = house_code
+        self.unit_number = unit_number
+        self.state = state
+        self.repeat = repeat
+        self.cancelled = False
+
+    @property
+    def key(self):
+        return (self.house_code, self.unit_number)
+
+    def next_when(self, now=None):
+        """Return time of next repeat after now (defaults to when), or None
+        if not recurring. Repeats missed before now are skipped.
+        Raises ValueError if repeat does not move the time forward.
+        """
+        if self.repeat is None:
+            return None
+        when = self.when
+        if now is None:
+            now = when
+        while True:
+            if callable(self.repeat):
+                next_when = self.repeat(when)
+                if next_when is None:
+                    return None
+            elif now > when:
+                # skip missed repeats without calling repeat for each one
+                next_when = when + ((now - when) // self.repeat + 1) * self.repeat
+            else:
+                next_when = when + self.repeat
+            if not next_when > when:
+                raise ValueError('repeat %r did not advance from %r' % (self.repeat, when))
+            when = next_when
+            if when > now:
+                return when
+
+    def __repr__(self):
+        return 'ScheduledCommand%r' % ((self.when, self.house_code, self.unit_number, self.state, self.repeat), )
+
+
+class Scheduler(object):
+    """Dispatch delayed and recurring X10 commands from a single thread.
+
+    A (house_code, unit_number) may have any number of pending commands,
+    e.g. on daily at sunset and off daily at 23:00. For motion timeouts
+    use replace=True so a new timeout replaces the previous one.
+    Use unit_number None for house code commands like ALL_OFF (not supported
+    by MochadDriver).
+    """
+
+    def __init__(self, driver, batch_window=0.1, log=None):
+        """
+        @param driver - X10Driver instance used to send due commands
+        @param batch_window - seconds, commands due within this long of
+            the first due command are sent with it as one batch
+        """
+        self.driver = driver
+        self.batch_window = batch_window
+        self.log = log or default_logger
+        self._heap = []  # (when, sequence, ScheduledCommand), may contain cancelled entries
+        self._pending = {}  # (house_code, unit_number) -> set of ScheduledCommand
+        self._pending_count = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def __len__(self):
+        return self._pending_count
+
+    def start(self):
+        """Start the dispatch thread (daemon)"""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='x10_any.scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the dispatch thread, pending commands are kept"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def call_at(self, when, house_code, unit_number, state, repeat=None, replace=False):
+        """Schedule X10 command at time when (seconds since epoch, see time.time()).
+
+        @param repeat - Optional, make command recurring. Either number of
+            seconds between runs or a callable taking the time the command
+            was due and returning the next time it should run (or None to
+            stop), e.g. for sunset. Runs missed, e.g. while the scheduler
+            was stopped, are skipped rather than sent late.
+        @param replace - if True first cancel pending one shot (not
+            recurring) commands for (house_code, unit_number), e.g. for
+            motion timeouts
+        Returns ScheduledCommand.
+        """
+        if repeat is not None and not callable(repeat) and not repeat > 0:
+            raise ValueError('repeat must be a positive number of seconds or callable, got %r' % (repeat, ))
+        house_code = normalize_housecode(house_code)
+        if unit_number is not None:
+            unit_number = normalize_unitnumber(unit_number)
+        command = ScheduledCommand(when, house_code, unit_number, state, repeat=repeat)
+        with self._condition:
+            if replace:
+                for previous in list(self._pending.get(command.key, ())):
+                    if previous.repeat is None:
+                        self._remove(previous)
+            self._push(command)
+            self._condition.notify()
+        return command
+
+    def call_later(self, delay, house_code, unit_number, state, repeat=None, replace=False):
+        """Schedule X10 command in delay seconds, see call_at()"""
+        return self.call_at(time.time() + delay, house_code, unit_number, state, repeat=repeat, replace=replace)
+
+    def cancel(self, house_code, unit_number):
+        """Cancel all pending commands for (house_code, unit_number).
+        Returns number of commands cancelled.
+        """
+        key = self._key(house_code, unit_number)
+        with self._condition:
+            commands = list(self._pending.get(key, ()))
+            for command in commands:
+                self._remove(command)
+            self._compact()
+        return len(commands)
+
+    def reschedule(self, house_code, unit_number, delay):
+        """Move all pending commands for (house_code, unit_number) to delay
+        seconds from now, recurring commands continue to repeat from then.
+        Returns number of commands moved.
+        """
+        key = self._key(house_code, unit_number)
+        when = time.time() + delay
+        with self._condition:
+            commands = list(self._pending.get(key, ()))
+            for command in commands:
+                self._remove(command)
+                self._push(ScheduledCommand(when, command.house_code, command.unit_number, command.state, repeat=command.repeat))
+            self._condition.notify()
+        return len(commands)
+
+    def pending(self, house_code, unit_number):
+        """Return list of pending ScheduledCommand for (house_code, unit_number), soonest first"""
+        key = self._key(house_code, unit_number)
+        with self._condition:
+            return sorted(self._pending.get(key, ()), key=lambda command: command.when)
+
+    def _key(self, house_code, unit_number):
+        house_code = normalize_housecode(house_code)
+        if unit_number is not None:
+            unit_number = normalize_unitnumber(unit_number)
+        return (house_code, unit_number)
+
+    def _push(self, command):
+        """Add command. Caller holds _condition"""
+        self._pending.setdefault(command.key, set()).add(command)
+        self._pending_count += 1
+        heapq.heappush(self._heap, (command.when, next(self._sequence), command))
+        self._compact()
+
+    def _remove(self, command):
+        """Remove pending command, its heap entry is dropped lazily. Caller holds _condition"""
+        command.cancelled = True
+        commands = self._pending[command.key]
+        commands.discard(command)
+        if not commands:
+            del self._pending[command.key]
+        self._pending_count -= 1
+
+    def _compact(self):
+        """Drop cancelled entries once they make up most of the heap. Caller holds _condition"""
+        if len(self._heap) > 2 * self._pending_count + 64:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+
+    def _pop_due(self, now):
+        """Return list of commands due now (plus batch_window). Caller holds _condition"""
+        due = []
+        while self._heap:
+            when, _, command = self._heap[0]
+            if command.cancelled:
+                heapq.heappop(self._heap)
+                continue
+            if when > now:
+                break
+            heapq.heappop(self._heap)
+            self._remove(command)
+            command.cancelled = False  # no longer pending, but not cancelled
+            due.append(command)
+            if len(due) == 1:
+                now += self.batch_window
+        return due
+
+    def _next_wait(self, now):
+        """Return seconds until next command is due, None if nothing pending. Caller holds _condition"""
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - now)
+
+    def _reschedule_repeats(self, due, now):
+        """Caller holds _condition"""
+        for command in due:
+            try:
+                when = command.next_when(now)
+            except Exception as ex:
+                self.log.error('ERROR: computing repeat for %r: %r', command, ex)
+                continue
+            if when is not None:
+                self._push(ScheduledCommand(when, command.house_code, command.unit_number, command.state, repeat=command.repeat))
+
+    def _dispatch(self, due):
+        commands = [(command.house_code, command.unit_number, command.state) for command in due]
+        self.log.debug('scheduler sending: %r', commands)
+        try:
+            self.driver.x10_commands(commands)
+        except X10BatchError as ex:
+            # the rest of the batch was still sent
+            for command, error in ex.errors:
+                self.log.error('ERROR: sending %r: %r', command, error)
+        except Exception as ex:
+            # keep the scheduler running
+            self.log.error('ERROR: sending %r: %r', commands, ex)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                now = time.time()
+                due = self._pop_due(now)
+                if due:
+                    self._reschedule_repeats(due, now)
+                else:
+                    self._condition.wait(self._next_wait(now))
+                    continue
+            self._dispatch(due)
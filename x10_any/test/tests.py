@@ -3,11 +3,35 @@
 # vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
 #
 
+import json
 import os
+import shutil
+import socket
+import subprocess
 import sys
-from unittest import main, TestCase
+import tempfile
+import threading
+import time
+from unittest import main, skipIf, TestCase
 
 import x10_any
+from x10_any.gateway import CommandBatcher, make_server, MAX_CONTENT_LENGTH, parse_commands
+from x10_any.registry import DriverRegistry, parse_driver_url
+from x10_any.scheduler import Scheduler
+
+try:
+    # Python 3
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    # Python 2
+    from urllib2 import HTTPError, Request, urlopen
+
+try:
+    import x10_any.cm17a as cm17a
+except ImportError:
+    # pyserial not available
+    cm17a = None
 
 
 class TestUtils(TestCase):
@@ -161,5 +185,775 @@ class TestUtils(TestCase):
         self.assertEqual(canon, result)
 
 
+class FakeMochad(object):
+    """Minimal mochad stand in, echoes transmitted commands like mochad does."""
+
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.device_address = self.server.getsockname()
+        self.received = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except socket.error:
+                return
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = client.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+            self.received.append(data)
+            try:
+                self.respond(client, data)
+            except socket.error:
+                pass  # sender did not wait for a response
+            client.close()
+
+    def respond(self, client, data):
+        for line in data.splitlines():
+            device_type, house_and_unit, state = line.split()
+            client.sendall(b'10/19 12:00:00 Tx ' + device_type.upper() + b' HouseUnit: ' + house_and_unit.upper() + b' Func: ' + state + b'\n')
+
+    def wait_for(self, count, timeout=2):
+        """Wait until count commands received, sender may not wait for a response"""
+        deadline = time.time() + timeout
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        self.server.close()
+
+
+class TestMochadDriverType(TestCase):
+
+    def test_default_type(self):
+        dev = x10_any.MochadDriver()
+        self.assertEqual(b'rf', dev._select_type('A', 'A1'))
+
+    def test_type_map_house_code(self):
+        dev = x10_any.MochadDriver(type_map={'a': 'pl'})
+        self.assertEqual(b'pl', dev._select_type('A', 'A1'))
+        self.assertEqual(b'rf', dev._select_type('B', 'B1'))
+
+    def test_type_map_unit_overrides_house_code(self):
+        dev = x10_any.MochadDriver(default_type='pl', type_map={'A': 'pl', 'a03': 'rf'})
+        self.assertEqual(b'rf', dev._select_type('A', 'A3'))
+        self.assertEqual(b'pl', dev._select_type('A', 'A4'))
+
+    def test_type_map_invalid_house_code(self):
+        def doit():
+            x10_any.MochadDriver(type_map={'Q': 'pl'})
+        self.assertRaises(x10_any.X10InvalidHouseCode, doit)
+
+    def test_adaptive_tries_both_then_fastest(self):
+        dev = x10_any.MochadDriver(adaptive=True)
+        self.assertEqual(b'rf', dev._select_type('A', 'A1'))
+        dev._record_latency('A1', b'rf', 0.5)
+        self.assertEqual(b'pl', dev._select_type('A', 'A1'))
+        dev._record_latency('A1', b'pl', 0.1)
+        self.assertEqual(b'pl', dev._select_type('A', 'A1'))
+
+    def test_adaptive_probes_slower_path(self):
+        dev = x10_any.MochadDriver(adaptive=True)
+        dev._record_latency('A1', b'rf', 0.5)
+        dev._record_latency('A1', b'pl', 0.1)
+        dev.command_count['A1'] = dev.probe_interval
+        self.assertEqual(b'rf', dev._select_type('A', 'A1'))
+
+    def test_adaptive_type_map_pinned(self):
+        dev = x10_any.MochadDriver(adaptive=True, type_map={'A1': 'pl'})
+        dev._record_latency('A1', b'rf', 0.1)
+        dev._record_latency('A1', b'pl', 0.5)
+        self.assertEqual(b'pl', dev._select_type('A', 'A1'))
+
+    def test_adaptive_measures_echo(self):
+        mochad = FakeMochad()
+        try:
+            dev = x10_any.MochadDriver(mochad.device_address, adaptive=True)
+            dev.x10_command('a', 1, x10_any.ON)
+            dev.x10_command('a', 1, x10_any.OFF)
+        finally:
+            mochad.close()
+        self.assertEqual([b'rf A1 ON\n', b'pl A1 OFF\n'], mochad.received)
+        self.assertEqual(set([b'rf', b'pl']), set(dev.latency['A1']))
+
+    def test_adaptive_ignores_other_unit_echo(self):
+        class FakeMochadOtherUnit(FakeMochad):
+            def respond(self, client, data):
+                client.sendall(b'10/19 12:00:00 Tx RF HouseUnit: A10 Func: On\n')
+                time.sleep(0.5)
+
+        mochad = FakeMochadOtherUnit()
+        try:
+            dev = x10_any.MochadDriver(mochad.device_address, adaptive=True, ack_timeout=0.2)
+            dev.x10_command('A', 1, x10_any.ON)
+        finally:
+            mochad.close()
+        self.assertEqual({b'rf': 0.2}, dev.latency['A1'])
+
+    def test_batch_single_connection(self):
+        mochad = FakeMochad()
+        try:
+            dev = x10_any.MochadDriver(mochad.device_address, type_map={'B': 'pl'})
+            dev.x10_commands([('a', 1, x10_any.ON), ('b', '2', x10_any.OFF)])
+            mochad.wait_for(1)
+        finally:
+            mochad.close()
+        self.assertEqual([b'rf A1 ON\npl B2 OFF\n'], mochad.received)
+
+
+MOCHAD_STATUS = b"""02/01 16:44:01 Device selected
+02/01 16:44:01 House P: 2
+02/01 16:44:01 Device status
+02/01 16:44:01 House P: 1=0,2=0,4=1
+02/01 16:44:01 House A: 10=1
+02/01 16:44:01 Security sensor status
+02/01 16:44:01 Sensor addr: 000003 Last: 1102:40 Arm_KR10A
+02/01 16:44:01 End status
+"""
+
+
+class FakeMochadStatus(FakeMochad):
+
+    def respond(self, client, data):
+        client.sendall(MOCHAD_STATUS)
+
+
+class TestMochadStatus(TestCase):
+
+    def test_parse(self):
+        canon = {
+            ('P', 1): x10_any.OFF,
+            ('P', 2): x10_any.OFF,
+            ('P', 4): x10_any.ON,
+            ('A', 10): x10_any.ON,
+        }
+        self.assertEqual(canon, x10_any.parse_mochad_status(MOCHAD_STATUS))
+
+    def test_parse_empty(self):
+        self.assertEqual({}, x10_any.parse_mochad_status(b'02/01 16:44:01 End status\n'))
+
+    def test_status_cached(self):
+        mochad = FakeMochadStatus()
+        try:
+            dev = x10_any.MochadDriver(mochad.device_address, status_interval=60)
+            result = dev.status()
+            self.assertEqual(x10_any.ON, result[('P', 4)])
+            self.assertEqual(result, dev.status())
+            self.assertEqual([b'st\n'], mochad.received)
+            dev.status(refresh=True)
+            self.assertEqual([b'st\n', b'st\n'], mochad.received)
+        finally:
+            mochad.close()
+
+    def test_status_cache_updated_by_commands(self):
+        class FakeMochadBoth(FakeMochadStatus):
+            def respond(self, client, data):
+                if data == b'st\n':
+                    FakeMochadStatus.respond(self, client, data)
+
+        mochad = FakeMochadBoth()
+        try:
+            dev = x10_any.MochadDriver(mochad.device_address, status_interval=60)
+            self.assertEqual(x10_any.OFF, dev.status()[('P', 1)])
+            dev.x10_command('P', 1, 'on')
+            dev.x10_commands([('P', 4, x10_any.OFF)])
+            result = dev.status()
+            self.assertEqual(x10_any.ON, result[('P', 1)])
+            self.assertEqual(x10_any.OFF, result[('P', 4)])
+            mochad.wait_for(3)
+            self.assertEqual(1, mochad.received.count(b'st\n'))
+        finally:
+            mochad.close()
+
+    def test_status_fetch_does_not_block_updates(self):
+        class FakeMochadSlow(FakeMochadStatus):
+            def respond(self, client, data):
+                release.wait(5)
+                FakeMochadStatus.respond(self, client, data)
+
+        release = threading.Event()
+        mochad = FakeMochadSlow()
+        try:
+            dev = x10_any.MochadDriver(mochad.device_address, status_interval=60)
+            thread = threading.Thread(target=dev.status)
+            thread.start()
+            mochad.wait_for(1)
+            start = time.time()
+            dev._update_status([('P', 1, x10_any.ON)])
+            self.assertTrue(time.time() - start < 1)
+            release.set()
+            thread.join(5)
+            # command sent during the fetch, so its result was not cached
+            dev.status()
+            self.assertEqual([b'st\n', b'st\n'], mochad.received)
+        finally:
+            release.set()
+            mochad.close()
+
+
+class TestBatchErrors(TestCase):
+
+    def test_mochad_bad_command_rest_sent(self):
+        mochad = FakeMochad()
+        try:
+            dev = x10_any.MochadDriver(mochad.device_address)
+
+            def doit():
+                dev.x10_commands([('A', 1, 'on'), ('A', 2, 'xdim 128'), ('Q', 3, 'on'), ('A', 4, 'off')])
+            self.assertRaises(x10_any.X10BatchError, doit)
+            mochad.wait_for(1)
+        finally:
+            mochad.close()
+        self.assertEqual([b'rf A1 on\nrf A4 off\n'], mochad.received)
+
+    def test_batch_error_lists_failed_commands(self):
+        dev = RecordingDriver()
+        try:
+            dev.x10_commands([('A', 1, 'on'), ('Q', 1, 'on')])
+        except x10_any.X10BatchError as ex:
+            self.assertEqual([('Q', 1, 'on')], [command for command, _ in ex.errors])
+        else:
+            self.fail('X10BatchError not raised')
+        self.assertEqual([[('A', 1, 'on')]], dev.batches)
+
+    @skipIf(x10_any.x10 is None or x10_any.firecracker is not None, 'requires builtin cm17a module')
+    def test_firecracker_bad_command_rest_sent(self):
+        sent = []
+        saved_send_commands = x10_any.x10.sendCommands
+        x10_any.x10.sendCommands = lambda port, commands: sent.append((port, commands))
+        try:
+            dev = x10_any.FirecrackerDriver('/dev/ttyTEST0')
+
+            def doit():
+                dev.x10_commands([('A', 1, 'on'), ('A', None, 'unknown'), ('A', 2, 'off')])
+            self.assertRaises(x10_any.X10BatchError, doit)
+        finally:
+            x10_any.x10.sendCommands = saved_send_commands
+        self.assertEqual([('/dev/ttyTEST0', 'A1 on, A2 off')], sent)
+
+    @skipIf(x10_any.x10 is None or x10_any.firecracker is not None, 'requires builtin cm17a module')
+    def test_firecracker_bad_unit_state_rest_sent(self):
+        sent = []
+        saved_send_commands = x10_any.x10.sendCommands
+        x10_any.x10.sendCommands = lambda port, commands: sent.append((port, commands))
+        try:
+            dev = x10_any.FirecrackerDriver('/dev/ttyTEST0')
+            try:
+                dev.x10_commands([('A', 1, 'on'), ('A', 2, 'blink'), ('A', 1, x10_any.ALL_OFF), ('A', 2, 'off')])
+            except x10_any.X10BatchError as ex:
+                self.assertEqual([('A', 2, 'blink'), ('A', 1, x10_any.ALL_OFF)], [command for command, _ in ex.errors])
+            else:
+                self.fail('X10BatchError not raised')
+        finally:
+            x10_any.x10.sendCommands = saved_send_commands
+        self.assertEqual([('/dev/ttyTEST0', 'A1 on, A2 off')], sent)
+
+
+class RecordingDriver(x10_any.X10Driver):
+    """Records batches instead of sending them"""
+
+    def __init__(self):
+        self.batches = []
+        self.sent = threading.Event()
+
+    def _x10_commands(self, commands):
+        self.batches.append(commands)
+        self.sent.set()
+
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        self.driver = RecordingDriver()
+        self.scheduler = Scheduler(self.driver, batch_window=0.05)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def wait_for_batches(self, count, timeout=2):
+        deadline = time.time() + timeout
+        while len(self.driver.batches) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_due_together_single_batch(self):
+        self.scheduler.call_later(0.05, 'a', 1, x10_any.OFF)
+        self.scheduler.call_later(0.06, 'A', 2, x10_any.OFF)
+        self.scheduler.start()
+        self.wait_for_batches(1)
+        time.sleep(0.1)
+        self.assertEqual([[('A', 1, x10_any.OFF), ('A', 2, x10_any.OFF)]], self.driver.batches)
+        self.assertEqual(0, len(self.scheduler))
+
+    def test_schedule_replaces_pending(self):
+        self.scheduler.call_later(0.05, 'A', 3, x10_any.ON, replace=True)
+        self.scheduler.call_later(0.1, 'A', 3, x10_any.OFF, replace=True)
+        self.assertEqual(1, len(self.scheduler))
+        self.scheduler.start()
+        self.wait_for_batches(1)
+        time.sleep(0.15)
+        self.assertEqual([[('A', 3, x10_any.OFF)]], self.driver.batches)
+
+    def test_multiple_pending_per_unit(self):
+        self.scheduler.call_later(0.05, 'A', 3, x10_any.ON, repeat=60)
+        self.scheduler.call_later(0.3, 'A', 3, x10_any.OFF, repeat=60)
+        self.assertEqual(2, len(self.scheduler.pending('A', 3)))
+        self.scheduler.start()
+        self.wait_for_batches(2)
+        self.assertEqual([[('A', 3, x10_any.ON)], [('A', 3, x10_any.OFF)]], self.driver.batches)
+        self.assertEqual(2, len(self.scheduler))
+
+    def test_replace_keeps_recurring(self):
+        self.scheduler.call_later(60, 'A', 3, x10_any.ON, repeat=24 * 60 * 60)
+        self.scheduler.call_later(60, 'A', 3, x10_any.OFF)
+        self.scheduler.call_later(60, 'A', 3, x10_any.OFF, replace=True)
+        self.assertEqual([x10_any.ON, x10_any.OFF], [command.state for command in self.scheduler.pending('A', 3)])
+
+    def test_cancel(self):
+        self.scheduler.start()
+        self.scheduler.call_later(0.05, 'A', 3, x10_any.OFF)
+        self.scheduler.call_later(0.05, 'A', 3, x10_any.ON, repeat=60)
+        self.assertEqual(2, self.scheduler.cancel('a', '3'))
+        self.assertEqual(0, self.scheduler.cancel('A', 3))
+        time.sleep(0.1)
+        self.assertEqual([], self.driver.batches)
+
+    def test_reschedule(self):
+        self.scheduler.call_later(0.05, 'A', 3, x10_any.OFF)
+        self.assertEqual(1, self.scheduler.reschedule('A', 3, 60))
+        self.assertEqual(0, self.scheduler.reschedule('A', 4, 60))
+        self.assertTrue(self.scheduler.pending('A', 3)[0].when > time.time() + 30)
+        self.scheduler.start()
+        time.sleep(0.1)
+        self.assertEqual([], self.driver.batches)
+
+    def test_repeat(self):
+        self.scheduler.call_later(0, 'A', None, x10_any.ALL_OFF, repeat=0.05)
+        self.scheduler.start()
+        self.wait_for_batches(3)
+        self.scheduler.stop()
+        self.assertEqual([('A', None, x10_any.ALL_OFF)], self.driver.batches[2])
+        self.assertEqual(1, len(self.scheduler))
+
+    def test_missed_repeats_skipped(self):
+        start = time.time() - 10.01
+        self.scheduler.call_at(start, 'A', 3, x10_any.ON, repeat=1)
+        self.scheduler.start()
+        self.wait_for_batches(1)
+        time.sleep(0.1)
+        self.assertEqual([[('A', 3, x10_any.ON)]], self.driver.batches)
+        next_when = self.scheduler.pending('A', 3)[0].when
+        self.assertTrue(time.time() < next_when <= start + 12, next_when - start)
+
+    def test_repeat_must_advance(self):
+        self.assertRaises(ValueError, self.scheduler.call_later, 0, 'A', 3, x10_any.ON, repeat=0)
+        self.assertRaises(ValueError, self.scheduler.call_later, 0, 'A', 3, x10_any.ON, repeat=-1)
+        self.scheduler.call_later(0, 'A', 3, x10_any.ON, repeat=lambda when: when)
+        self.scheduler.start()
+        self.wait_for_batches(1)
+        time.sleep(0.1)
+        self.assertEqual([[('A', 3, x10_any.ON)]], self.driver.batches)
+        self.assertEqual(0, len(self.scheduler))
+
+    def test_many_pending_compacted(self):
+        for _ in range(1000):
+            self.scheduler.call_later(60, 'A', 3, x10_any.OFF, replace=True)
+        self.assertEqual(1, len(self.scheduler))
+        self.assertTrue(len(self.scheduler._heap) < 100)
+
+
+class TestGateway(TestCase):
+
+    def setUp(self):
+        self.driver = RecordingDriver()
+        self.server = make_server(self.driver, ('127.0.0.1', 0), batch_window=0.1, wait_timeout=2)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05, ))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.batcher.stop()
+
+    def post(self, data, path=''):
+        request = Request(self.url + path, json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'})
+        try:
+            response = urlopen(request)
+        except HTTPError as ex:
+            return ex.code, json.loads(ex.read().decode('utf-8'))
+        return response.getcode(), json.loads(response.read().decode('utf-8'))
+
+    def test_single_command_queued(self):
+        status, result = self.post({'house': 'a', 'unit': 1, 'state': 'ON'})
+        self.assertEqual((202, {'queued': 1}), (status, result))
+        self.driver.sent.wait(2)
+        self.assertEqual([[('A', 1, 'ON')]], self.driver.batches)
+
+    def test_batch_wait(self):
+        commands = [{'house': 'A', 'unit': 1, 'state': 'ON'}, {'house': 'B', 'unit': None, 'state': 'all_units_off'}]
+        status, result = self.post({'commands': commands, 'wait': True})
+        self.assertEqual((200, {'sent': 2}), (status, result))
+        self.assertEqual([[('A', 1, 'ON'), ('B', None, 'all_units_off')]], self.driver.batches)
+
+    def test_wait_query_parameter(self):
+        status, result = self.post({'house': 'A', 'unit': 2, 'state': 'OFF'}, path='?wait=1')
+        self.assertEqual((200, {'sent': 1}), (status, result))
+
+    def test_invalid_house_code(self):
+        status, result = self.post({'house': 'Q', 'unit': 1, 'state': 'ON'})
+        self.assertEqual(400, status)
+        self.assertEqual([], self.driver.batches)
+
+    def test_bad_state_rejected(self):
+        status, result = self.post({'house': 'A', 'unit': 1, 'state': 128})
+        self.assertEqual(400, status)
+        self.assertEqual([], self.driver.batches)
+
+    def test_wait_must_be_boolean(self):
+        command = {'house': 'A', 'unit': 1, 'state': 'ON'}
+        self.assertRaises(ValueError, parse_commands, json.dumps({'commands': [command], 'wait': 'false'}).encode('utf-8'))
+        self.assertEqual(([('A', 1, 'ON')], False), parse_commands(json.dumps({'commands': [command], 'wait': False}).encode('utf-8')))
+        status, result = self.post({'commands': [command], 'wait': 1})
+        self.assertEqual(400, status)
+        self.assertEqual([], self.driver.batches)
+
+    def post_raw(self, content_length, body=b''):
+        """Return HTTP status code for POST with the given Content-Length header"""
+        sock = socket.create_connection(self.server.server_address, 2)
+        try:
+            sock.sendall(b'POST / HTTP/1.0\r\nContent-Length: ' + content_length.encode('ascii') + b'\r\n\r\n' + body)
+            response = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+        return int(response.split()[1])
+
+    def test_content_length_checked(self):
+        self.assertEqual(400, self.post_raw('-1'))
+        self.assertEqual(400, self.post_raw('x'))
+        self.assertEqual(413, self.post_raw(str(MAX_CONTENT_LENGTH + 1)))
+        self.assertEqual([], self.driver.batches)
+
+
+class FailingDriver(RecordingDriver):
+    """Records batches, fails commands with state 'bad'"""
+
+    def _x10_commands(self, commands):
+        RecordingDriver._x10_commands(self, [command for command in commands if command[2] != 'bad'])
+        errors = [(command, NotImplementedError(command[2])) for command in commands if command[2] == 'bad']
+        if errors:
+            raise x10_any.X10BatchError(errors)
+
+
+class TestCommandBatcher(TestCase):
+
+    def test_submissions_merged(self):
+        driver = RecordingDriver()
+        batcher = CommandBatcher(driver, batch_window=1)
+        try:
+            queued = [batcher.submit([('A', unit_number, 'ON')]) for unit_number in range(1, 4)]
+            for item in queued:
+                self.assertTrue(item.wait(5))
+        finally:
+            batcher.stop()
+        self.assertEqual([[('A', 1, 'ON'), ('A', 2, 'ON'), ('A', 3, 'ON')]], driver.batches)
+
+    def test_bad_command_only_fails_submitter(self):
+        driver = FailingDriver()
+        batcher = CommandBatcher(driver, batch_window=1)
+        try:
+            good = batcher.submit([('A', 1, 'ON')])
+            bad = batcher.submit([('A', 2, 'ON'), ('A', 3, 'bad')])
+            self.assertTrue(good.wait(5))
+            self.assertRaises(x10_any.X10BatchError, bad.wait, 5)
+        finally:
+            batcher.stop()
+        self.assertEqual([[('A', 1, 'ON'), ('A', 2, 'ON')]], driver.batches)
+
+
+class TestRegistry(TestCase):
+
+    def test_parse_mochad_defaults(self):
+        self.assertEqual((x10_any.MochadDriver, ('localhost', 1099), {}, {}), parse_driver_url('mochad://'))
+
+    def test_parse_mochad_options(self):
+        canon = (x10_any.MochadDriver, ('mochad.example.com', 1100), {'adaptive': True}, {'default_type': 'pl'})
+        self.assertEqual(canon, parse_driver_url('MOCHAD://Mochad.Example.com:1100?type=PL&adaptive=1'))
+
+    def test_parse_mochad_unknown_option(self):
+        def doit():
+            parse_driver_url('mochad://localhost?colour=red')
+        self.assertRaises(x10_any.X10BaseException, doit)
+
+    def test_parse_mochad_invalid_type(self):
+        def doit():
+            parse_driver_url('mochad://localhost?type=xx')
+        self.assertRaises(x10_any.X10BaseException, doit)
+
+    def test_parse_cm17a(self):
+        self.assertEqual((x10_any.FirecrackerDriver, '/dev/ttyUSB0', {}, {}), parse_driver_url('cm17a:///dev/ttyUSB0'))
+        self.assertEqual((x10_any.FirecrackerDriver, 'COM11', {}, {}), parse_driver_url('firecracker://COM11'))
+        self.assertEqual((x10_any.FirecrackerDriver, None, {}, {}), parse_driver_url('cm17a://'))
+
+    def test_parse_unsupported(self):
+        def doit():
+            parse_driver_url('http://localhost')
+        self.assertRaises(x10_any.X10BaseException, doit)
+
+    def test_one_driver_per_endpoint(self):
+        registry = DriverRegistry()
+        dev1 = registry.get_driver('mochad://localhost:1099?type=pl')
+        dev2 = registry.get_driver('mochad://LOCALHOST')
+        dev3 = registry.get_driver('mochad://localhost:1100')
+        self.assertTrue(dev1.driver is dev2.driver)
+        self.assertFalse(dev1.driver is dev3.driver)
+        self.assertEqual(b'pl', dev1.default_type)
+        self.assertEqual(b'rf', dev2.default_type)
+        self.assertEqual(2, len(registry))
+
+        shared = dev1.driver
+        dev1.close()
+        dev1.close()
+        self.assertTrue(hasattr(shared, 'device_address'))
+        dev2.close()
+        self.assertFalse(hasattr(shared, 'device_address'))
+        self.assertEqual(1, len(registry))
+        dev3.close()
+        self.assertEqual(0, len(registry))
+
+    def test_release_while_locked(self):
+        # e.g. a handle garbage collected (__del__) while get_driver() holds the lock
+        registry = DriverRegistry()
+        dev = registry.get_driver('mochad://')
+        shared = dev.driver
+        counts = []
+
+        def doit():
+            registry._lock_registry()
+            try:
+                dev.close()
+                counts.append(len(registry))  # applied once unlocked
+            finally:
+                registry._unlock_registry()
+        thread = threading.Thread(target=doit)
+        thread.daemon = True
+        thread.start()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([1], counts)
+        self.assertEqual(0, len(registry))
+        self.assertFalse(hasattr(shared, 'device_address'))
+
+    @skipIf(x10_any.x10 is None and x10_any.firecracker is None, 'requires CM17A module')
+    @skipIf(sys.platform.startswith('win'), 'symlinks')
+    def test_cm17a_port_resolved(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            port_name = os.path.join(temp_dir, 'ttyTEST0')
+            open(port_name, 'w').close()
+            os.symlink(port_name, os.path.join(temp_dir, 'by-id'))
+            registry = DriverRegistry()
+            dev1 = registry.get_driver('cm17a://' + port_name)
+            dev2 = registry.get_driver('cm17a://' + os.path.join(temp_dir, 'by-id'))
+            self.assertTrue(dev1.driver is dev2.driver)
+            dev1.close()
+            dev2.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_conflicting_driver_options(self):
+        registry = DriverRegistry()
+        dev = registry.get_driver('mochad://localhost?adaptive=1')
+        try:
+            registry.get_driver('mochad://localhost?adaptive=1').close()
+
+            def doit():
+                registry.get_driver('mochad://localhost?adaptive=0')
+            self.assertRaises(x10_any.X10BaseException, doit)
+        finally:
+            dev.close()
+        self.assertEqual(0, len(registry))
+
+    def test_shared_commands(self):
+        mochad = FakeMochad()
+        registry = DriverRegistry()
+        try:
+            dev1 = registry.get_driver('mochad://%s:%d' % mochad.device_address)
+            dev2 = registry.get_driver('mochad://%s:%d?type=pl' % mochad.device_address)
+            dev1.x10_command('A', 1, x10_any.ON)
+            mochad.wait_for(1)
+            dev2.x10_commands([('A', 2, x10_any.ON)])
+            mochad.wait_for(2)
+            dev1.close()
+            dev2.close()
+        finally:
+            mochad.close()
+        self.assertEqual([b'rf A1 ON\n', b'pl A2 ON\n'], mochad.received)
+
+
+@skipIf(cm17a is None, 'cm17a requires pyserial')
+class FakeSerial(object):
+    """Stand in for serial.Serial, records RTS/DTR changes"""
+
+    def __init__(self, port=None, **kwargs):
+        self.port = port
+        self.kwargs = kwargs
+        self.changes = 0
+        self.closed = False
+
+    def setRTS(self, value):
+        self.changes += 1
+
+    def setDTR(self, value):
+        self.changes += 1
+
+    def close(self):
+        self.closed = True
+
+
+# holds the port lock in a separate process until stdin is closed
+lock_holder_script = """
+import sys
+import x10_any.cm17a as cm17a
+cm17a.lockDirectory = sys.argv[1]
+lock = cm17a.PortLock(sys.argv[2], timeout=5)
+lock.acquire()
+sys.stdout.write('locked\\n')
+sys.stdout.flush()
+sys.stdin.read()
+lock.release()
+"""
+
+
+class TestCm17aPortLock(TestCase):
+
+    def setUp(self):
+        self.saved_lock_directory = cm17a.lockDirectory
+        cm17a.lockDirectory = tempfile.mkdtemp()
+        self.port_name = '/dev/ttyTEST0'
+
+    def tearDown(self):
+        shutil.rmtree(cm17a.lockDirectory)
+        cm17a.lockDirectory = self.saved_lock_directory
+
+    def test_default_lock_directory_shared(self):
+        saved_environ = dict(os.environ)
+        os.environ['TMPDIR'] = os.environ['TMP'] = os.environ['TEMP'] = cm17a.lockDirectory
+        try:
+            lock_directory = cm17a._defaultLockDirectory()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_environ)
+        self.assertNotEqual(cm17a.lockDirectory, lock_directory)
+        self.assertTrue(os.path.isdir(lock_directory))
+
+    def test_acquire_release(self):
+        lock = cm17a.PortLock(self.port_name, timeout=1)
+        with lock:
+            self.assertTrue(lock.waited >= 0)
+            self.assertFalse(cm17a.mutex.acquire(False))
+        self.assertTrue(cm17a.mutex.acquire(False))
+        cm17a.mutex.release()
+
+    @skipIf(sys.platform.startswith('win'), 'POSIX permissions')
+    def test_queue_directory_shared_between_users(self):
+        lock = cm17a.PortLock(self.port_name, timeout=1)
+        with lock:
+            pass
+        self.assertEqual(0o1777, os.stat(lock.queueDirectory).st_mode & 0o7777)
+
+    def test_timeout_port_locked_elsewhere(self):
+        lock = cm17a.PortLock(self.port_name, timeout=0.1)
+        fd = cm17a._openLockFile(lock.fileName)
+        try:
+            self.assertTrue(cm17a._tryLock(fd))
+            self.assertRaises(cm17a.PortLockTimeout, lock.acquire)
+        finally:
+            os.close(fd)
+        self.assertTrue(cm17a.mutex.acquire(False))
+        cm17a.mutex.release()
+
+    def start_lock_holder(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(x10_any.__file__)))] + sys.path)
+        process = subprocess.Popen([sys.executable, '-c', lock_holder_script, cm17a.lockDirectory, self.port_name],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.assertEqual(b'locked', process.stdout.readline().strip())
+        return process
+
+    def test_send_commands_port_locked_by_other_process(self):
+        saved = cm17a.serial.Serial, cm17a.leadInOutDelay, cm17a.bitDelay
+        ports = []
+
+        def open_serial(**kwargs):
+            ports.append(FakeSerial(**kwargs))
+            return ports[-1]
+        cm17a.serial.Serial = open_serial
+        cm17a.leadInOutDelay = cm17a.bitDelay = 0
+        process = self.start_lock_holder()
+        try:
+            self.assertRaises(cm17a.PortLockTimeout, cm17a.sendCommands, self.port_name, 'A1 On', timeout=0.1)
+            self.assertEqual([], ports)  # port not opened without the lock
+
+            # other process releases the lock while we wait
+            timer = threading.Timer(0.3, process.stdin.close)
+            timer.start()
+            waited = cm17a.sendCommands(self.port_name, 'A1 On', timeout=5)
+            timer.join()
+        finally:
+            if not process.stdin.closed:
+                process.stdin.close()
+            process.wait()
+            process.stdout.close()
+            cm17a.serial.Serial, cm17a.leadInOutDelay, cm17a.bitDelay = saved
+        self.assertTrue(0.2 <= waited < 5, waited)
+        self.assertEqual(1, len(ports))
+        self.assertTrue(ports[0].changes > 0)
+        self.assertTrue(ports[0].closed)
+        self.assertEqual(0, process.returncode)
+
+    def test_timeout_live_ticket_queued_first(self):
+        lock = cm17a.PortLock(self.port_name, timeout=0.1)
+        os.makedirs(lock.queueDirectory)
+        ticket_name = os.path.join(lock.queueDirectory, '%017.6f-0-0' % 1)
+        fd = cm17a._openLockFile(ticket_name)
+        try:
+            self.assertTrue(cm17a._tryLock(fd))
+            self.assertRaises(cm17a.PortLockTimeout, lock.acquire)
+        finally:
+            os.close(fd)
+        self.assertEqual([os.path.basename(ticket_name)], os.listdir(lock.queueDirectory))
+
+    def test_stale_ticket_removed(self):
+        lock = cm17a.PortLock(self.port_name, timeout=1)
+        os.makedirs(lock.queueDirectory)
+        ticket_name = os.path.join(lock.queueDirectory, '%017.6f-0-0' % 1)
+        os.close(cm17a._openLockFile(ticket_name))
+        with lock:
+            pass
+        self.assertEqual([], os.listdir(lock.queueDirectory))
+
+    def test_stale_tmp_ticket_removed(self):
+        lock = cm17a.PortLock(self.port_name, timeout=1)
+        os.makedirs(lock.queueDirectory)
+        old_name = os.path.join(lock.queueDirectory, '%017.6f-0-0.tmp' % 1)
+        new_name = os.path.join(lock.queueDirectory, '%017.6f-0-0.tmp' % time.time())
+        os.close(cm17a._openLockFile(old_name))
+        os.close(cm17a._openLockFile(new_name))
+        with lock:
+            pass
+        # recent one may still be locked and renamed by its creator
+        self.assertEqual([os.path.basename(new_name)], os.listdir(lock.queueDirectory))
+
+
 if __name__ == "__main__":
     sys.exit(main())